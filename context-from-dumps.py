@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import json
 import argparse
 from time import sleep
@@ -7,8 +9,13 @@ from enum import Enum
 from pickle import Unpickler
 from collections import defaultdict
 
-from contexts import write_context_to_file
+from contexts import write_context_to_file, SpillingIncidence, parse_size
+from contexts import write_contexts_to_files
+from memory import MemoryReport
 from wikidata import context_from_dump, is_not_deprecated
+from wikidata import attribute_support_from_dump, supported_attributes
+from wikidata import DistinctCountSketch, write_pruning_report, entity_sample
+from wikidata import load_entity_filter
 from wikidata import has_claims, has_qualifiers, maybe_entity_value
 from wikidata import all_direct_instances_in_class, format_datavalue
 from wikidata import all_direct_classes_for_values_of, has_meaningful_value
@@ -101,6 +108,55 @@ COLOURING_MAP = {
     }
 
 
+UNCLASSIFIED = 'unclassified'
+UNGROUPED = 'ungrouped'
+
+
+def property_of(attribute):
+    """return the property an attribute was generated from."""
+    return attribute.lstrip('^').split('@', 1)[0]
+
+
+def partition_by_class(instances):
+    def _partition(eid, props):
+        if eid not in instances or not instances[eid]:
+            return {UNCLASSIFIED: props}
+
+        return {qid: props for qid in instances[eid]}
+    return _partition
+
+
+def partition_by_property_group(groups):
+    names = defaultdict(list)
+    for name, pids in groups.items():
+        for pid in pids:
+            names[pid].append(name)
+
+    names = dict(names)
+    ungrouped = [UNGROUPED]
+
+    def _partition(eid, props):
+        result = defaultdict(list)
+
+        for prop in props:
+            for name in names.get(property_of(prop), ungrouped):
+                result[name].append(prop)
+
+        return result
+    return _partition
+
+
+def partition_path(path, name):
+    """return the output path for partition `name`, either by filling
+    in `{}` in `path` or by adding `name` before the extension.
+    """
+    if '{}' in path:
+        return path.replace('{}', name)
+
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, name, ext)
+
+
 def process_properties(labels,
                        instances,
                        subclasses,
@@ -113,7 +169,7 @@ def process_properties(labels,
     def process_entity(eid, entity):
         def _matches(pid):
             return all([not properties or pid in properties,
-                        not filter_entities or pid in filter_entities,
+                        filter_entities is None or pid in filter_entities,
             ])
 
 
@@ -218,38 +274,226 @@ if __name__ == '__main__':
     parser.add_argument('--entities-from-file',
                         metavar='Eidfile',
                         dest='eidfile', default=None,
-                        help='restrict entities to those in Eidfile')
+                        help='restrict entities to those in Eidfile (one id '
+                        'per line, or a binary filter)')
+    parser.add_argument('--min-attribute-support',
+                        metavar='N', type=int, default=None,
+                        dest='min_support',
+                        help='drop attributes holding for fewer than N objects')
+    parser.add_argument('--max-attributes',
+                        metavar='N', type=int, default=None,
+                        help='keep only the N best supported attributes')
+    parser.add_argument('--support-sketch',
+                        metavar='WIDTHxDEPTH', default=None,
+                        help='estimate attribute support with a count-min '
+                        'sketch of HyperLogLog counters instead of '
+                        'counting exactly; estimates may be too low or too '
+                        'high by about 13%%')
+    parser.add_argument('--pruning-report',
+                        metavar='Reportfile', default=None,
+                        help='write dropped attributes to Reportfile')
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument('--sample',
+                          metavar='Rate', type=float, default=None,
+                          help='only use a deterministic sample of a '
+                          'fraction Rate of all entities')
+    sampling.add_argument('--sample-size',
+                          metavar='N', type=int, default=None,
+                          help='only use a deterministic sample of N entities')
+    parser.add_argument('--memory-limit',
+                        metavar='Size', default=None,
+                        help='spill the incidence relation to disk once it '
+                        'takes about Size (e.g., 4G) of memory')
+    parser.add_argument('--spill-directory',
+                        metavar='Dir', default=None,
+                        help='write spilled run files below Dir')
+    parser.add_argument('--partition-by',
+                        choices=['class', 'property-group'], default=None,
+                        help='write one context per direct class of the '
+                        'objects or per property group')
+    parser.add_argument('--property-group',
+                        action='append', metavar='Name=Pid,...',
+                        dest='groups', default=[],
+                        help='define a property group for --partition-by')
+    parser.add_argument('--jobs', '-j',
+                        metavar='N', type=int, default=2,
+                        help='write partitions using N processes (default: '
+                        '2); each process may end up with its own copy of '
+                        'the labels, so memory grows with N')
+    parser.add_argument('--memory-report',
+                        metavar='Reportfile', default=None,
+                        help='write a JSON memory report to Reportfile')
 
     args = parser.parse_args()
-    properties = args.properties
-
-    for qid in args.qids:
-        properties += all_direct_instances_in_class(qid)
-
-    colouring = COLOURINGS[args.colouring]
-    kwargs = {'properties': properties,
-              'colouring': COLOURINGS[args.colouring],
-              'filter_property': args.filter_property,
-              'filter_value': args.filter_value,
-              }
-
-    with open(args.indexes, 'rb') as idxfile:
-        pickle = Unpickler(idxfile)
-        indexes = pickle.load()
-        kwargs.update(indexes)
-
-    if args.eidfile is not None:
-        entities = set([])
-        with open(args.eidfile, 'r') as eidfile:
-            for line in eidfile:
-                entities |= {line.strip()}
-
-        kwargs.update({'filter_entities': entities})
-
-    process_entity = process_properties(**kwargs)
-    result = context_from_dump(dump=args.dump,
-                               properties_for_entity=process_entity,
-                               postprocess=postprocess(**kwargs))
-
-    with open(args.context, 'w') as outfile:
-        write_context_to_file(outfile=outfile, **result)
+
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error('--sample must be in (0, 1]')
+
+    if args.sample_size is not None and args.sample_size < 1:
+        parser.error('--sample-size must be at least 1')
+
+    if args.max_attributes is not None and args.max_attributes < 1:
+        parser.error('--max-attributes must be at least 1')
+
+    if args.min_support is not None and args.min_support < 1:
+        parser.error('--min-attribute-support must be at least 1')
+
+    sketch = None
+    if args.support_sketch is not None:
+        width, _, depth = args.support_sketch.partition('x')
+        try:
+            sketch = int(width), int(depth)
+        except ValueError:
+            sketch = (0, 0)
+
+        if min(sketch) < 1:
+            parser.error('--support-sketch must be WIDTHxDEPTH with '
+                         'positive integers')
+
+    memory_limit = None
+    if args.memory_limit is not None:
+        try:
+            memory_limit = parse_size(args.memory_limit)
+        except ValueError:
+            memory_limit = 0
+
+        if memory_limit < 1:
+            parser.error("invalid --memory-limit `{}'".format(
+                args.memory_limit))
+
+    if args.partition_by is not None and args.memory_limit is not None:
+        parser.error('--memory-limit cannot be combined with --partition-by')
+
+    if args.partition_by == 'property-group' and not args.groups:
+        parser.error('--partition-by property-group needs --property-group')
+
+    groups = {}
+    for group in args.groups:
+        name, _, pids = group.partition('=')
+        if not pids:
+            parser.error("property group `{}' has no properties".format(group))
+
+        if (name in ['', '.', '..', UNGROUPED, UNCLASSIFIED] or '/' in name or
+            os.sep in name or (os.altsep and os.altsep in name)):
+            parser.error("invalid property group name `{}'".format(name))
+
+        groups[name] = set(pids.split(','))
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    if args.partition_by is not None:
+        directory = os.path.dirname(partition_path(args.context, 'partition'))
+        if not os.path.isdir(directory or os.curdir):
+            parser.error("no directory `{}' for the partitioned contexts"
+                         .format(directory))
+
+    report = MemoryReport(args.memory_report).start()
+    try:
+        properties = args.properties
+
+        for qid in args.qids:
+            properties += all_direct_instances_in_class(qid)
+
+        colouring = COLOURINGS[args.colouring]
+        kwargs = {'properties': properties,
+                  'colouring': COLOURINGS[args.colouring],
+                  'filter_property': args.filter_property,
+                  'filter_value': args.filter_value,
+                  }
+
+        with open(args.indexes, 'rb') as idxfile:
+            pickle = Unpickler(idxfile)
+            indexes = pickle.load()
+            kwargs.update(indexes)
+
+        if args.eidfile is not None:
+            kwargs.update(
+                {'filter_entities': load_entity_filter(args.eidfile)})
+
+        report.stage('indexes',
+                     labels=kwargs['labels'],
+                     instances=kwargs['instances'],
+                     subclasses=kwargs['subclasses'],
+                     filter_entities=kwargs.get('filter_entities'))
+
+        process_entity = process_properties(**kwargs)
+        attribute_filter = None
+        sample, _ = entity_sample(args.dump, rate=args.sample,
+                                  size=args.sample_size)
+
+        if args.min_support is not None or args.max_attributes is not None:
+            support = None
+            if sketch is not None:
+                support = DistinctCountSketch(
+                    *sketch, candidates=args.max_attributes or 0)
+
+            support = attribute_support_from_dump(
+                dump=args.dump,
+                properties_for_entity=process_entity,
+                support=support,
+                sample=sample)
+            attribute_filter = supported_attributes(
+                support,
+                min_support=args.min_support or 1,
+                max_attributes=args.max_attributes)
+
+        partition = None
+        if args.partition_by == 'class':
+            partition = partition_by_class(kwargs['instances'])
+        elif args.partition_by == 'property-group':
+            partition = partition_by_property_group(groups)
+
+        incidence = None
+        if args.memory_limit is not None:
+            incidence = SpillingIncidence(memory_limit,
+                                          directory=args.spill_directory)
+
+        process_context = postprocess(**kwargs)
+        scanned = []
+
+        def _postprocess(context):
+            if partition is None:
+                report.stage('scan', context=context)
+            elif not scanned:
+                # called once per partition, but only after the whole scan
+                report.stage('scan')
+                scanned.append(True)
+
+            return process_context(context)
+
+        try:
+            result = context_from_dump(dump=args.dump,
+                                       properties_for_entity=process_entity,
+                                       postprocess=_postprocess,
+                                       attribute_filter=attribute_filter,
+                                       sample=sample,
+                                       incidence=incidence,
+                                       partition=partition)
+
+            if partition is not None:
+                report.stage('postprocess', contexts=result)
+                with report.paused():
+                    write_contexts_to_files(
+                        result,
+                        lambda name: partition_path(args.context, name),
+                        jobs=args.jobs)
+            else:
+                report.stage('postprocess')
+                with open(args.context, 'w') as outfile:
+                    write_context_to_file(outfile=outfile, **result)
+        finally:
+            if incidence is not None:
+                incidence.close()
+
+        if attribute_filter is not None:
+            if args.pruning_report is not None:
+                with open(args.pruning_report, 'w') as reportfile:
+                    write_pruning_report(support, attribute_filter, reportfile)
+            else:
+                write_pruning_report(support, attribute_filter, sys.stderr,
+                                     details=False)
+
+        report.stage('write')
+    finally:
+        report.write()
@@ -1,3 +1,163 @@
+import os
+import sys
+import json
+import heapq
+import shutil
+import tempfile
+import multiprocessing
+from itertools import groupby
+from collections import defaultdict
+
+
+SIZE_SUFFIXES = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# maximal number of run files merged at once
+MERGE_FAN_IN = 128
+
+
+def parse_size(size):
+    """return the number of bytes for a size such as `512M` or `4G`."""
+    size = size.strip().upper().rstrip('B')
+
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+
+    return int(size)
+
+
+class SpillingIncidence(object):
+    """incidence relation that keeps at most (approximately) `limit`
+    bytes of (object, attribute) pairs in memory, spilling them to
+    sorted run files in a temporary directory below `directory` once
+    the limit is reached.
+    """
+
+    def __init__(self, limit, directory=None):
+        self.limit = limit
+        self.directory = directory
+        self.spilldir = None
+        self.rows = defaultdict(set)
+        self.size = 0
+        self.runs = []
+
+    def add(self, obj, attributes):
+        if not attributes:
+            return
+
+        row = self.rows.get(obj)
+        if row is None:
+            table = sys.getsizeof(self.rows)
+            row = self.rows[obj] = set([])
+            self.size += (sys.getsizeof(obj) +
+                          sys.getsizeof(self.rows) - table)
+            before = 0
+        else:
+            before = sys.getsizeof(row)
+
+        for attribute in attributes:
+            if attribute not in row:
+                row.add(attribute)
+                self.size += sys.getsizeof(attribute)
+
+        # the row's hash table grows as attributes are added
+        self.size += sys.getsizeof(row) - before
+
+        if self.size >= self.limit:
+            self.spill()
+
+    def _sorted_pairs(self):
+        for obj in sorted(self.rows):
+            for attribute in sorted(self.rows[obj]):
+                yield obj, attribute
+
+    def _write_run(self, pairs):
+        if self.spilldir is None:
+            self.spilldir = tempfile.mkdtemp(prefix='spill-',
+                                             dir=self.directory)
+
+        run = tempfile.NamedTemporaryFile(mode='w', suffix='.run',
+                                          dir=self.spilldir, delete=False)
+        self.runs.append(run.name)
+
+        with run:
+            for pair in pairs:
+                print(json.dumps(pair), file=run)
+
+    def spill(self):
+        if not self.rows:
+            return
+
+        self._write_run(self._sorted_pairs())
+        self.rows = defaultdict(set)
+        self.size = 0
+
+    def _read_run(self, path):
+        with open(path, 'r') as run:
+            for line in run:
+                yield tuple(json.loads(line))
+
+    def _merge_runs(self):
+        """merge the oldest `MERGE_FAN_IN` run files into a new one until
+        at most `MERGE_FAN_IN` remain, so that no merge has more files
+        open at once.
+        """
+        while len(self.runs) > MERGE_FAN_IN:
+            batch = self.runs[:MERGE_FAN_IN]
+            self._write_run(heapq.merge(*[self._read_run(path)
+                                          for path in batch]))
+            del self.runs[:MERGE_FAN_IN]
+
+            for path in batch:
+                os.remove(path)
+
+    def merged_rows(self):
+        """yield (object, attributes) for all objects with some attribute
+        in sorted order, merging the run files with the pairs still held
+        in memory.
+        """
+        self._merge_runs()
+        pairs = heapq.merge(self._sorted_pairs(),
+                            *[self._read_run(path) for path in self.runs])
+
+        for obj, group in groupby(pairs, key=lambda pair: pair[0]):
+            yield obj, {attribute for _, attribute in group}
+
+    def close(self):
+        if self.spilldir is not None:
+            shutil.rmtree(self.spilldir, ignore_errors=True)
+
+        self.spilldir = None
+        self.runs = []
+        self.rows = defaultdict(set)
+        self.size = 0
+
+
+def _rows(context):
+    """return the objects of `context` together with an iterator of
+    their rows, in matching order.
+    """
+    incidence = context['incidence']
+
+    if not isinstance(incidence, SpillingIncidence):
+        objects = context['objects']
+        return objects, (incidence[obj] for obj in objects)
+
+    objects = sorted(context['objects'])
+
+    def _merged():
+        merged = incidence.merged_rows()
+        current = next(merged, None)
+
+        for obj in objects:
+            if current is not None and current[0] == obj:
+                yield current[1]
+                current = next(merged, None)
+            else:
+                yield set([])
+
+    return objects, _merged()
+
+
 def write_context_to_file(context, outfile, labels={}):
     def _label(needle):
         if needle in labels:
@@ -37,19 +197,56 @@ def write_context_to_file(context, outfile, labels={}):
         return '{}{}{}'.format('^' if reverse else '',
                                prop, annotation)
 
+    objects, rows = _rows(context)
+
     print('B\n', file=outfile)
-    print(len(context['objects']), file=outfile)
+    print(len(objects), file=outfile)
     print(len(context['attributes']), file=outfile)
     print('', file=outfile)
 
-    for obj in context['objects']:
+    for obj in objects:
         print(_label(obj), file=outfile)
 
     for att in context['attributes']:
         print(_label(att), file=outfile)
 
-    for obj in context['objects']:
-        print(*['X' if att in context['incidence'][obj]
+    for row in rows:
+        print(*['X' if att in row
                 else '.'
                 for att in context['attributes']],
               sep='', file=outfile)
+
+
+# contexts to be written by forked workers, see `write_contexts_to_files`
+_PENDING = {}
+
+
+def _write_pending(name):
+    path, result = _PENDING[name]
+
+    with open(path, 'w') as outfile:
+        write_context_to_file(outfile=outfile, **result)
+
+    return name
+
+
+def write_contexts_to_files(results, path_for, jobs=None):
+    """write each of the contexts in `results`, a dict from names to
+    arguments for `write_context_to_file`, to the file `path_for(name)`,
+    using `jobs` worker processes. Workers are forked, so the contexts
+    are not copied to them.
+    """
+    _PENDING.update({name: (path_for(name), result)
+                     for name, result in results.items()})
+
+    try:
+        if jobs == 1:
+            for name in results:
+                _write_pending(name)
+            return
+
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for _ in pool.imap_unordered(_write_pending, list(results)):
+                pass
+    finally:
+        _PENDING.clear()
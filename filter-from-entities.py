@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+import argparse
+from wikidata import EntityFilter
+from memory import MemoryReport
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a binary entity '
+                                     'filter for --entities-from-file from '
+                                     'a list of entity ids')
+    parser.add_argument('eidfile',
+                        help='path to file with one entity id per line')
+    parser.add_argument('output',
+                        help='path to output filter file')
+    parser.add_argument('--memory-report',
+                        metavar='Reportfile', default=None,
+                        help='write a JSON memory report to Reportfile')
+
+    args = parser.parse_args()
+    report = MemoryReport(args.memory_report).start()
+    try:
+        entities = EntityFilter.from_file(args.eidfile)
+        report.stage('load', entities=entities)
+        entities.write(args.output)
+        report.stage('write')
+    finally:
+        report.write()
@@ -5,6 +5,7 @@ from pickle import Pickler
 from collections import defaultdict
 from wikidata import process_wikidata_dump, maybe_entity_value
 from wikidata import PROPERTY_SUBCLASS_OF, PROPERTY_INSTANCE_OF
+from memory import MemoryReport
 
 
 def transitive_closure(relation):
@@ -70,15 +71,29 @@ if __name__ == '__main__':
     parser.add_argument('--language',
                         metavar='Lang', default='en',
                         help='include labels in language Lang')
+    parser.add_argument('--memory-report',
+                        metavar='Reportfile', default=None,
+                        help='write a JSON memory report to Reportfile')
 
     args = parser.parse_args()
-    labels, instances, subclasses = direct_relations_from_dump(
-        args.dump, language=args.language)
-    transitive_subclasses = transitive_closure(subclasses)
-
-    with open(args.output, 'wb') as outfile:
-        pickle = Pickler(outfile)
-        pickle.dump({'labels': labels,
-                     'instances': instances,
-                     'subclasses': transitive_subclasses,
-        })
+    report = MemoryReport(args.memory_report).start()
+    try:
+        labels, instances, subclasses = direct_relations_from_dump(
+            args.dump, language=args.language)
+        report.stage('scan',
+                     labels=labels,
+                     instances=instances,
+                     subclasses=subclasses)
+        transitive_subclasses = transitive_closure(subclasses)
+        report.stage('closure', subclasses=transitive_subclasses)
+
+        with open(args.output, 'wb') as outfile:
+            pickle = Pickler(outfile)
+            pickle.dump({'labels': labels,
+                         'instances': instances,
+                         'subclasses': transitive_subclasses,
+            })
+
+        report.stage('write')
+    finally:
+        report.write()
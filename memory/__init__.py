@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import platform
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+from itertools import islice
+
+
+def _current_rss():
+    """return the current resident set size in bytes, or `None` if it
+    cannot be determined.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _children_rss():
+    """return the summed resident set size in bytes of the running
+    child processes (e.g., forked writers), or `None` if it cannot be
+    determined.
+    """
+    try:
+        pids = set([])
+        for task in os.listdir('/proc/self/task'):
+            path = '/proc/self/task/{}/children'.format(task)
+            with open(path, 'r') as children:
+                pids |= set(children.read().split())
+    except OSError:
+        return None
+
+    rss = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/statm'.format(pid), 'r') as statm:
+                rss += int(statm.read().split()[1]) * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            continue    # child has already exited
+
+    return rss
+
+
+def _peak_rss(who=resource.RUSAGE_SELF):
+    """return the peak resident set size in bytes, of this process or,
+    for `RUSAGE_CHILDREN`, of the largest terminated child process.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return peak         # already in bytes
+
+    return peak * 1024
+
+
+def _version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def deep_size(obj, sample=1000):
+    """estimate the memory used by `obj` and everything reachable from
+    it through containers and instance attributes. Containers with more
+    than `sample` entries are extrapolated from their first `sample`
+    entries (and nested containers from fewer), so the estimate takes
+    bounded time and memory however large `obj` is. Objects shared
+    between the visited entries are counted only once.
+    """
+    seen = set([])
+
+    def _size(current, sample):
+        if id(current) in seen:
+            return 0
+
+        seen.add(id(current))
+        size = sys.getsizeof(current)
+
+        if isinstance(current, (str, bytes, bytearray, memoryview,
+                                int, float)):
+            return size
+
+        if isinstance(current, dict):
+            entries = ((key, value) for key, value in current.items())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            entries = ((entry, ) for entry in current)
+        elif hasattr(current, '__dict__'):
+            return size + _size(vars(current), sample)
+        else:
+            return size
+
+        nested = max(sample // 10, 10)
+        sampled = 0
+        total = 0
+        for entry in islice(entries, sample):
+            sampled += 1
+            total += sum(_size(part, nested) for part in entry)
+
+        if not sampled:
+            return size
+
+        return size + int(total * len(current) / sampled)
+
+    return _size(obj, sample)
+
+
+class MemoryReport(object):
+    """opt-in memory accounting for a run. Samples the RSS every
+    `interval` seconds and records tracemalloc statistics and
+    estimated deep sizes of the given structures at each stage. Does
+    nothing unless `path` is given. The report is saved as JSON to
+    `path` after each stage and every `save_every` seconds, so that it
+    survives runs that are killed, and `write` saves the final one.
+    """
+
+    def __init__(self, path=None, interval=1.0, top=10, save_every=30.0):
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.save_every = save_every
+        self.samples = []
+        self.stages = []
+        self._stopped = threading.Event()
+        self._sampler = None
+        self._started = None
+        self._finished = False
+        self._lock = threading.Lock()
+        self._version = None
+
+    def start(self):
+        if self.path is None:
+            return self
+
+        self._started = time.monotonic()
+        self._version = _version()
+        tracemalloc.start()
+        self._start_sampler()
+
+        return self
+
+    def _start_sampler(self):
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _stop_sampler(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    @contextmanager
+    def paused(self):
+        """stop tracing while the block runs, e.g., so that forked worker
+        processes do not pay for tracemalloc. The RSS of this process
+        and its children is still sampled. Traced memory of later stages
+        only counts allocations made after the block.
+        """
+        if self.path is None:
+            yield
+            return
+
+        tracemalloc.stop()
+
+        try:
+            yield
+        finally:
+            tracemalloc.start()
+
+    def _elapsed(self):
+        return time.monotonic() - self._started
+
+    def _sample(self):
+        saved = time.monotonic()
+
+        while True:
+            with self._lock:
+                self.samples.append({'time': self._elapsed(),
+                                     'rss': _current_rss(),
+                                     'children_rss': _children_rss(),
+                                     })
+
+            if time.monotonic() - saved >= self.save_every:
+                self._save()
+                saved = time.monotonic()
+
+            if self._stopped.wait(self.interval):
+                return
+
+    def _save(self, complete=False, error=None):
+        """write the report collected so far, replacing the previous
+        one only once the new one is complete on disk.
+        """
+        with self._lock:
+            report = {'argv': sys.argv,
+                      'version': self._version,
+                      'python': platform.python_version(),
+                      'complete': complete,
+                      'error': error,
+                      'time': self._elapsed(),
+                      'peak_rss': _peak_rss(),
+                      'peak_children_rss': _peak_rss(resource.RUSAGE_CHILDREN),
+                      'samples': list(self.samples),
+                      'stages': list(self.stages),
+                      }
+
+            partial = '{}.partial'.format(self.path)
+            with open(partial, 'w') as outfile:
+                json.dump(report, outfile, indent=2)
+
+            os.replace(partial, self.path)
+
+    def stage(self, name, **structures):
+        """record the memory use at the end of stage `name`, including
+        deep size estimates of `structures` (see `deep_size`).
+        """
+        if self.path is None:
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+
+        stage = {
+            'stage': name,
+            'time': self._elapsed(),
+            'rss': _current_rss(),
+            'peak_rss': _peak_rss(),
+            'peak_children_rss': _peak_rss(resource.RUSAGE_CHILDREN),
+            'traced': current,
+            'traced_peak': peak,
+            'top': [{'location': str(stat.traceback[0]),
+                     'size': stat.size,
+                     'count': stat.count,
+                     }
+                    for stat in snapshot.statistics('lineno')[:self.top]],
+            'estimated_sizes': {key: deep_size(value)
+                                for key, value in structures.items()},
+            }
+
+        with self._lock:
+            self.stages.append(stage)
+
+        self._save()
+
+    def write(self):
+        """stop sampling and tracing, and write the final report. When
+        called while an exception is propagating (e.g., from a `finally`
+        clause), the exception is recorded in the report.
+        """
+        if self.path is None or self._finished:
+            return
+
+        self._finished = True
+        self._stop_sampler()
+        tracemalloc.stop()
+
+        error = sys.exc_info()[1]
+        self._save(complete=error is None,
+                   error=repr(error) if error is not None else None)
@@ -2,12 +2,14 @@
 
 import json
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 from wikidata import process_wikidata_dump, is_not_deprecated
+from wikidata import entity_sample, scaled_estimate, load_entity_filter
 from wikidata import has_claims, has_qualifiers, maybe_entity_value
 from wikidata import all_direct_instances_in_class, format_datavalue
 from wikidata import all_direct_classes_for_values_of, has_meaningful_value
+from memory import MemoryReport
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate statistics from a JSON dump')
@@ -20,75 +22,132 @@ if __name__ == '__main__':
     parser.add_argument('--entities-from-file',
                         metavar='Eidfile',
                         dest='eidfile', default=None,
-                        help='restrict entities to those in Eidfile')
+                        help='restrict entities to those in Eidfile (one id '
+                        'per line, or a binary filter)')
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument('--sample',
+                          metavar='Rate', type=float, default=None,
+                          help='estimate statistics from a deterministic '
+                          'sample of a fraction Rate of all entities')
+    sampling.add_argument('--sample-size',
+                          metavar='N', type=int, default=None,
+                          help='estimate statistics from a deterministic '
+                          'sample of N entities')
+    parser.add_argument('--memory-report',
+                        metavar='Reportfile', default=None,
+                        help='write a JSON memory report to Reportfile')
 
     entities = set([])
     args = parser.parse_args()
 
-    if args.eidfile is not None:
-        with open(args.eidfile, 'r') as eidfile:
-            for line in eidfile:
-                entities |= {line.strip()}
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error('--sample must be in (0, 1]')
 
-    stats = {'__all__': { 'properties': set([]),
-                          'items': set([]),
-                          'statements': 0,
-                          }
-             }
-    props = defaultdict(set)
+    if args.sample_size is not None and args.sample_size < 1:
+        parser.error('--sample-size must be at least 1')
 
-    for qid in args.qids:
-        stats[qid] = { 'properties': all_direct_instances_in_class(qid),
-                       'items': set([]),
-                       'statements': 0,
-                       }
+    report = MemoryReport(args.memory_report).start()
+    try:
+        if args.eidfile is not None:
+            entities = load_entity_filter(args.eidfile)
 
-        for pid in stats[qid]['properties']:
-            props[pid] |= {qid}
+        report.stage('filter', entities=entities)
+        filtering = bool(entities)
 
-    props = dict(props)
-    for entity in process_wikidata_dump(args.dump):
-        eid = entity['id']
+        stats = {'__all__': { 'properties': set([]),
+                              'items': set([]),
+                              'statements': 0,
+                              'subjects': 0,
+                              'squares': 0,
+                              }
+                 }
+        props = defaultdict(set)
 
-        if entities and eid not in entities:
-            continue
+        for qid in args.qids:
+            stats[qid] = { 'properties': all_direct_instances_in_class(qid),
+                           'items': set([]),
+                           'statements': 0,
+                           'subjects': 0,
+                           'squares': 0,
+                           }
 
-        for prop, claims in entity['claims'].items():
-            if entities and prop not in entities:
-                continue
-
-            if props:
-                if prop not in props:
-                    continue
-
-                for qid in props[prop]:
-                    stats[qid]['items'] |= {eid}
+            for pid in stats[qid]['properties']:
+                props[pid] |= {qid}
 
-            stats['__all__']['items'] |= {eid}
-            stats['__all__']['properties'] |= {prop}
+        props = dict(props)
+        sample, rate = entity_sample(args.dump, rate=args.sample,
+                                     size=args.sample_size)
 
-            for claim in claims:
-                if (is_not_deprecated(claim) and
-                    has_meaningful_value(claim)):
+        for entity in process_wikidata_dump(args.dump, sample=sample):
+            eid = entity['id']
 
-                    value = maybe_entity_value(claim)
-
-                    if value:
-                        if entities and value not in entities:
-                            continue
-                        stats['__all__']['items'] |= {value}
-                    stats['__all__']['statements'] += 1
+            if filtering and eid not in entities:
+                continue
 
-                    if props:
-                        for qid in props[prop]:
-                            if value:
-                                stats[qid]['items'] |= {value}
-                            stats[qid]['statements'] += 1
+            subject_of = set([])
+            statements = Counter()
 
+            for prop, claims in entity['claims'].items():
+                if filtering and prop not in entities:
+                    continue
 
-    for qid, stat in stats.items():
-        print('class {}: {} items, {} properties, {} statements'.format(
-            qid,
-            len(stat['items']),
-            len(stat['properties']),
-            stat['statements']))
+                if props:
+                    if prop not in props:
+                        continue
+
+                    for qid in props[prop]:
+                        stats[qid]['items'] |= {eid}
+                        subject_of |= {qid}
+
+                stats['__all__']['items'] |= {eid}
+                subject_of |= {'__all__'}
+                stats['__all__']['properties'] |= {prop}
+
+                for claim in claims:
+                    if (is_not_deprecated(claim) and
+                        has_meaningful_value(claim)):
+
+                        value = maybe_entity_value(claim)
+
+                        if value:
+                            if filtering and value not in entities:
+                                continue
+                            stats['__all__']['items'] |= {value}
+                        stats['__all__']['statements'] += 1
+                        statements['__all__'] += 1
+
+                        if props:
+                            for qid in props[prop]:
+                                if value:
+                                    stats[qid]['items'] |= {value}
+                                stats[qid]['statements'] += 1
+                                statements[qid] += 1
+
+            for qid in subject_of:
+                stats[qid]['subjects'] += 1
+
+            for qid, count in statements.items():
+                stats[qid]['squares'] += count * count
+
+        report.stage('scan', stats=stats)
+
+        for qid, stat in stats.items():
+            print('class {}: {} items, {} properties, {} statements'.format(
+                qid,
+                len(stat['items']),
+                len(stat['properties']),
+                stat['statements']))
+
+            if sample is not None:
+                print('  estimated from a {:.2%} sample: '
+                      '{:.0f} [{:.0f}--{:.0f}] subjects, '
+                      '{:.0f} [{:.0f}--{:.0f}] statements'.format(
+                          rate,
+                          *scaled_estimate(stat['subjects'], stat['subjects'],
+                                           rate),
+                          *scaled_estimate(stat['statements'], stat['squares'],
+                                           rate)))
+
+        report.stage('write')
+    finally:
+        report.write()
@@ -1,6 +1,12 @@
+import re
 import json
+import math
+import mmap
+import struct
+import heapq
+import hashlib
 import requests
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
 TOOL_BANNER = '#TOOL:conexp-clj Python Helper\n{}'
@@ -94,9 +100,70 @@ def all_instances_in_class(qid, language='en'):
     return _labelled_map_from_bindings(result, 'qid')
 
 
-def process_wikidata_dump(dump):
+ENTITY_ID = re.compile(r'"id"\s*:\s*"([^"]+)"')
+
+
+def _entity_ids_in_dump(dump):
+    """return the ids of the entities in `dump` without decoding them."""
     with open(dump, 'r') as dumpfile:
         for line in dumpfile:
+            match = ENTITY_ID.search(line)
+            if match:
+                yield match.group(1)
+
+
+def sample_fraction(eid):
+    """return a deterministic pseudo-random number in [0, 1) for the
+    entity `eid`.
+    """
+    digest = hashlib.blake2b(eid.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') / 2 ** 64
+
+
+def entity_sample(dump, rate=None, size=None):
+    """return a predicate selecting a deterministic sample of the
+    entities in `dump`, together with the sampling rate. Either sample a
+    fraction `rate` of all entities, or exactly `size` entities (which
+    needs a cheap pass over the entity ids in `dump`).
+    """
+    if size is not None:
+        smallest = heapq.nsmallest(size + 1, (sample_fraction(eid)
+                                              for eid in _entity_ids_in_dump(dump)))
+        if len(smallest) <= size:
+            return None, 1.0
+
+        rate = smallest[-1]
+
+    if rate is None or rate >= 1.0:
+        return None, 1.0
+
+    return lambda eid: sample_fraction(eid) < rate, rate
+
+
+def scaled_estimate(total, squares, rate, z=1.96):
+    """return the (Horvitz-Thompson) estimate for a sum over all
+    entities, given the `total` and the sum of `squares` of the
+    per-entity values over an entity sample taken with `rate`, together
+    with lower and upper bounds of the confidence interval for `z`.
+    """
+    estimate = total / rate
+    bound = z * math.sqrt((1 - rate) * squares) / rate
+
+    return estimate, max(total, estimate - bound), estimate + bound
+
+
+def process_wikidata_dump(dump, sample=None):
+    """yield the entities in `dump`. If `sample` is given, only yield
+    entities whose id is selected by `sample`; the id is matched on the
+    raw line, so unsampled entities are never decoded.
+    """
+    with open(dump, 'r') as dumpfile:
+        for line in dumpfile:
+            if sample is not None:
+                match = ENTITY_ID.search(line)
+                if match and not sample(match.group(1)):
+                    continue
+
             try:
                 entity = json.loads(line[:-2])
             except json.decoder.JSONDecodeError:
@@ -105,33 +172,447 @@ def process_wikidata_dump(dump):
             yield entity
 
 
+def _add_to_context(context, eid, props):
+    context['objects'] |= {eid}
+    context['attributes'] |= set(props)
+
+    incidence = context['incidence']
+    if hasattr(incidence, 'add'):
+        incidence.add(eid, props)
+    else:
+        incidence[eid] |= set(props)
+
+
+def _add_to_background(context, eid, props):
+    try:
+        context['background'][eid] &= set(props)
+    except KeyError:
+        try:
+            context['background'][eid] = set(props)
+        except KeyError:
+            context['background'] = {eid: set(props)}
+
+
 def context_from_dump(dump,
                       properties_for_entity,
-                      postprocess):
-    context = {'objects': set([]),
-               'attributes': set([]),
-               'incidence': defaultdict(set)}
+                      postprocess,
+                      attribute_filter=None,
+                      sample=None,
+                      incidence=None,
+                      partition=None):
+    """build a formal context from the entities in `dump`. If
+    `attribute_filter` is given, only attributes for which it returns
+    `True` are recorded in the context. If `sample` is given, only
+    entities selected by it are processed. Rows are collected in
+    `incidence` if given (e.g., a `contexts.SpillingIncidence`), and in
+    a dict of sets otherwise.
+
+    If `partition` is given, it maps an object and its attributes to a
+    dict from partition names to the attributes of the object in that
+    partition, and a dict from partition names to postprocessed
+    contexts is returned instead.
+    """
+    def _new_context():
+        return {'objects': set([]),
+                'attributes': set([]),
+                'incidence': defaultdict(set)}
+
+    context = _new_context()
+    if incidence is not None:
+        context['incidence'] = incidence
 
-    for entity in process_wikidata_dump(dump):
+    partitions = defaultdict(_new_context)
+
+    for entity in process_wikidata_dump(dump, sample=sample):
         eid = entity['id']
 
         properties, background = properties_for_entity(eid, entity)
 
         for eid, props in properties.items():
-            context['objects'] |= {eid}
-            context['attributes'] |= set(props)
-            context['incidence'][eid] |= set(props)
+            if attribute_filter is not None:
+                props = [prop for prop in props if attribute_filter(prop)]
+
+            if partition is None:
+                _add_to_context(context, eid, props)
+            else:
+                for name, part in partition(eid, props).items():
+                    _add_to_context(partitions[name], eid, part)
 
         for eid, props in background.items():
+            if partition is None:
+                _add_to_background(context, eid, props)
+            else:
+                for part in partitions.values():
+                    if eid in part['objects']:
+                        _add_to_background(part, eid, props)
+
+    if partition is None:
+        return postprocess(context)
+
+    return {name: postprocess(part) for name, part in partitions.items()}
+
+
+class DistinctCountSketch(object):
+    """approximate numbers of distinct items per key in bounded memory:
+    a count-min sketch whose cells are HyperLogLog counters with
+    `registers` registers each. If `candidates` is positive, the
+    (approximately) `candidates` keys with most items are tracked for
+    `most_common`.
+
+    Unlike a count-min sketch of plain counters, estimates can be too
+    low as well as too high: each HyperLogLog counter is off by about
+    1.04 / sqrt(`registers`) (13% for 64 registers) in either
+    direction, and taking the minimum over the rows favours the
+    lowest. Keys close to a threshold may thus end up on either side.
+    """
+
+    def __init__(self, width, depth, candidates=0, registers=64):
+        self.width = width
+        self.depth = depth
+        self.candidates = candidates
+        self.registers = registers
+        self.bits = registers.bit_length() - 1
+        self.tables = [bytearray(width * registers) for _ in range(depth)]
+        self.heavy = set([])
+
+        if registers >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / registers)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[registers]
+
+    def _buckets(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def _estimate(self, table, bucket):
+        cells = table[bucket * self.registers:(bucket + 1) * self.registers]
+        estimate = (self.alpha * self.registers ** 2 /
+                    sum(2.0 ** -rank for rank in cells))
+        zeros = cells.count(0)
+
+        if estimate <= 2.5 * self.registers and zeros:
+            # small range correction
+            estimate = self.registers * math.log(self.registers / zeros)
+
+        return estimate
+
+    def __getitem__(self, key):
+        return round(min(self._estimate(table, bucket)
+                         for table, bucket in zip(self.tables,
+                                                  self._buckets(key))))
+
+    def add(self, key, item):
+        digest = int.from_bytes(hashlib.blake2b(item.encode('utf-8'),
+                                                digest_size=8).digest(),
+                                'little')
+        register = digest & (self.registers - 1)
+        rank = 64 - self.bits - (digest >> self.bits).bit_length() + 1
+
+        for table, bucket in zip(self.tables, self._buckets(key)):
+            offset = bucket * self.registers + register
+            if table[offset] < rank:
+                table[offset] = rank
+
+        if self.candidates > 0:
+            self.heavy |= {key}
+            if len(self.heavy) > 2 * self.candidates:
+                self.heavy = {key for key, _
+                              in self.most_common(self.candidates)}
+
+    def most_common(self, n=None):
+        ranked = sorted(((key, self[key]) for key in self.heavy),
+                        key=lambda item: (-item[1], item[0]))
+        return ranked if n is None else ranked[:n]
+
+
+def attribute_support_from_dump(dump, properties_for_entity, support=None,
+                                sample=None):
+    """count, for each attribute, the number of distinct objects it is
+    generated for by `properties_for_entity`, without building the
+    context. Unless `support` is given, counts are exact and returned
+    as a `Counter`: attributes of an entity's own row are counted once
+    per entity, and for reverse attributes (starting with `^`), which
+    are generated for claim values, the distinct objects are
+    collected. Otherwise, `support` is a `DistinctCountSketch` that is
+    updated with all (attribute, object) pairs.
+    """
+    exact = support is None
+    counts = Counter()
+    holders = defaultdict(set)
+
+    for entity in process_wikidata_dump(dump, sample=sample):
+        properties, _ = properties_for_entity(entity['id'], entity)
+
+        for obj, props in properties.items():
+            for prop in set(props):
+                if not exact:
+                    support.add(prop, obj)
+                elif prop[0] == '^':
+                    holders[prop] |= {obj}
+                else:
+                    counts[prop] += 1
+
+    if not exact:
+        return support
+
+    for prop, objs in holders.items():
+        counts[prop] = len(objs)
+
+    return counts
+
+
+class SupportedAttributes(object):
+    """predicate selecting the attributes with at least `min_support`
+    objects in `support`, restricted to the `max_attributes` best
+    supported ones if given. For a sketch, each attribute is estimated
+    only once, and the estimates are kept in `estimates`. The number of
+    rejected attribute occurrences is counted in `rejected`.
+    """
+
+    def __init__(self, support, min_support=1, max_attributes=None):
+        self.support = support
+        self.min_support = min_support
+        self.kept = None
+        self.estimates = None
+        self.rejected = 0
+
+        if max_attributes is not None:
+            ranked = sorted(support.most_common(),
+                            key=lambda item: (-item[1], item[0]))
+            self.kept = {attribute
+                         for attribute, count in ranked[:max_attributes]
+                         if count >= min_support}
+
+        if not isinstance(support, Counter):
+            self.estimates = {}
+
+    def selects(self, attribute):
+        """return whether `attribute` is kept, without counting it."""
+        if self.estimates is None:
+            count = self.support[attribute]
+        else:
             try:
-                context['background'][eid] &= set(props)
+                count = self.estimates[attribute]
             except KeyError:
-                try:
-                    context['background'][eid] = set(props)
-                except KeyError:
-                    context['background'] = {eid: set(props)}
+                count = self.estimates[attribute] = self.support[attribute]
 
-    return postprocess(context)
+        if self.kept is not None:
+            return attribute in self.kept
+
+        return count >= self.min_support
+
+    def __call__(self, attribute):
+        keep = self.selects(attribute)
+        if not keep:
+            self.rejected += 1
+
+        return keep
+
+
+def supported_attributes(support, min_support=1, max_attributes=None):
+    """return a predicate selecting the attributes with at least
+    `min_support` objects in `support`, restricted to the
+    `max_attributes` best supported ones if given.
+    """
+    return SupportedAttributes(support,
+                               min_support=min_support,
+                               max_attributes=max_attributes)
+
+
+def write_pruning_report(support, keep, outfile, details=True):
+    """report which attributes of `support` are dropped by `keep`, a
+    `SupportedAttributes` that has been used for a context. For a
+    sketch, only the attributes `keep` has seen can be reported, with
+    their estimated support. When `details` is `False`, only print a
+    summary.
+    """
+    if isinstance(support, Counter):
+        counts = support
+        estimated = ''
+    else:
+        counts = keep.estimates
+        estimated = 'an estimated '
+
+    dropped = sorted(((attribute, count)
+                      for attribute, count in counts.items()
+                      if not keep.selects(attribute)),
+                     key=lambda item: (-item[1], item[0]))
+
+    print('kept {} of {} attributes, dropped {} ({}{} incidences, '
+          '{} rejected occurrences)'.format(
+              len(counts) - len(dropped), len(counts), len(dropped),
+              estimated, sum(count for _, count in dropped),
+              keep.rejected), file=outfile)
+
+    if not isinstance(support, Counter):
+        print('support estimated with a {}x{} sketch, attributes close to '
+              'the threshold may have been dropped or kept wrongly'.format(
+                  support.width, support.depth), file=outfile)
+
+    if not details:
+        return
+
+    for attribute, count in dropped:
+        print('{}\t{}'.format(count, attribute), file=outfile)
+
+
+class EntityFilter(object):
+    """a set of entity ids, stored as bitmaps over the numeric part of
+    item and property ids. Other ids (e.g., lexemes) are kept in a
+    plain set.
+    """
+
+    MAGIC = b'WDEF1'
+    HEADER = struct.Struct('<QQQQ')
+    # text files with at most this many ids are loaded into a plain set
+    # by `load_entity_filter`
+    SET_LIMIT = 1000000
+    # larger ids are kept in the plain set, so that a single bad id
+    # cannot blow up the bitmaps (which take up to 512MB each)
+    MAX_ID = 2 ** 32
+
+    def __init__(self, items=None, properties=None, others=None, count=0):
+        self.bitmaps = {'Q': items if items is not None else bytearray(),
+                        'P': properties if properties is not None else bytearray(),
+                        }
+        self.others = others if others is not None else set([])
+        self.count = count
+
+    def _locate(self, eid):
+        """return the bitmap and bit for `eid`, or `None` if `eid` is
+        not a well-formed item or property id below `MAX_ID`.
+        """
+        digits = eid[1:]
+        if (eid[:1] not in self.bitmaps or not digits.isascii() or
+            not digits.isdigit() or digits[0] == '0' or len(digits) > 10):
+            return None
+
+        number = int(digits)
+        if number >= self.MAX_ID:
+            return None
+
+        return self.bitmaps[eid[0]], number
+
+    def add(self, eid):
+        if eid in self:
+            return
+
+        located = self._locate(eid)
+        if located is None:
+            self.others |= {eid}
+        else:
+            bitmap, number = located
+            byte = number >> 3
+            if byte >= len(bitmap):
+                bitmap.extend(bytes(max(byte + 1 - len(bitmap), len(bitmap))))
+            bitmap[byte] |= 1 << (number & 7)
+
+        self.count += 1
+
+    def __contains__(self, eid):
+        # same checks as `_locate`, inlined since this is called for
+        # every subject, property and value while scanning a dump
+        bitmap = self.bitmaps.get(eid[:1])
+        digits = eid[1:]
+        if (bitmap is None or not digits.isdigit() or digits[0] == '0' or
+            not digits.isascii() or len(digits) > 10):
+            return eid in self.others
+
+        number = int(digits)
+        if number >= self.MAX_ID:
+            return eid in self.others
+
+        byte = number >> 3
+        return byte < len(bitmap) and (bitmap[byte] >> (number & 7)) & 1 == 1
+
+    def __len__(self):
+        return self.count
+
+    def write(self, path):
+        """write the filter to `path` in a binary format that
+        `from_file` maps into memory.
+        """
+        others = '\n'.join(sorted(self.others)).encode('utf-8')
+
+        with open(path, 'wb') as outfile:
+            outfile.write(self.MAGIC)
+            outfile.write(self.HEADER.pack(self.count,
+                                           len(self.bitmaps['Q']),
+                                           len(self.bitmaps['P']),
+                                           len(others)))
+            outfile.write(self.bitmaps['Q'])
+            outfile.write(self.bitmaps['P'])
+            outfile.write(others)
+
+    @classmethod
+    def is_binary(cls, path):
+        """return whether `path` holds a binary filter written by
+        `write`.
+        """
+        with open(path, 'rb') as infile:
+            return infile.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def from_file(cls, path):
+        """load a filter from `path`, which is either a binary filter
+        written by `write`, or a text file with one entity id per line.
+        """
+        if not cls.is_binary(path):
+            entities = cls()
+            with open(path, 'r') as eidfile:
+                for line in eidfile:
+                    eid = line.strip()
+                    if eid:
+                        entities.add(eid)
+
+            return entities
+
+        with open(path, 'rb') as infile:
+            mapped = memoryview(mmap.mmap(infile.fileno(), 0,
+                                          access=mmap.ACCESS_READ))
+
+        start = len(cls.MAGIC)
+        count, items, properties, others = cls.HEADER.unpack_from(mapped,
+                                                                  start)
+        start += cls.HEADER.size
+        others = bytes(mapped[start + items + properties:
+                              start + items + properties + others])
+
+        return cls(items=mapped[start:start + items],
+                   properties=mapped[start + items:
+                                     start + items + properties],
+                   others=set(others.decode('utf-8').split('\n'))
+                   if others else set([]),
+                   count=count)
+
+
+def load_entity_filter(path, limit=EntityFilter.SET_LIMIT):
+    """load the entity ids in `path` for membership tests. Text files
+    with at most `limit` ids are loaded into a plain `set`, which is
+    faster to query but takes more memory; everything else is loaded
+    into an `EntityFilter`.
+    """
+    if EntityFilter.is_binary(path):
+        return EntityFilter.from_file(path)
+
+    ids = set([])
+    with open(path, 'r') as eidfile:
+        for line in eidfile:
+            eid = line.strip()
+            if eid:
+                ids.add(eid)
+
+            if len(ids) > limit:
+                break
+        else:
+            return ids
+
+    ids.clear()
+    return EntityFilter.from_file(path)
 
 
 def has_claims(entity):